@@ -1,4 +1,4 @@
-from .singlequbit_gates import Rx, Ry, Hadamard
+from .singlequbit_gates import Rx, Ry, Hadamard, get_conns_batched
 
 # from .ising import Ising
 from netket.operator import IsingJax as Ising
@@ -1,4 +1,5 @@
-from functools import partial
+from functools import partial, lru_cache, cached_property
+import math
 
 import numpy as np
 
@@ -10,69 +11,96 @@ from jax.tree_util import register_pytree_node_class
 from netket.operator import DiscreteJaxOperator, spin
 
 
-@register_pytree_node_class
-class Rx(DiscreteJaxOperator):
-    def __init__(self, hi, idx, angle):
-        super().__init__(hi)
-        self._local_states = jnp.asarray(hi.local_states)
-        self._idx = idx
-        self._angle = angle
+@lru_cache(maxsize=None)
+def _sections(n):
+    """Read-only sections array for `n` samples with 2 connected elements each."""
+    sections = np.arange(2, 2 * n + 2, 2)
+    sections.setflags(write=False)
+    return sections
 
-    @property
-    def angle(self):
-        """
-        The angle of this rotation.
-        """
-        return self._angle
+
+def _static_idx(idx):
+    """Converts scalar qubit indices to a python int, so they are hashable."""
+    if np.ndim(idx) == 0:
+        return int(idx)
+    return idx
+
+
+def _cos_sin_half(angle):
+    """Returns `(cos(angle/2), sin(angle/2))`, as python floats if not traced."""
+    if isinstance(angle, jax.core.Tracer):
+        return jnp.cos(angle / 2), jnp.sin(angle / 2)
+    return math.cos(angle / 2), math.sin(angle / 2)
+
+
+class _SingleQubitGate(DiscreteJaxOperator):
+    """
+    Base class for gates acting on a single qubit, which connect every
+    configuration to itself and to the one where qubit `idx` is flipped.
+
+    Subclasses only need to set `_kind`, the key in `_MEL_FNS` of the function
+    computing their matrix elements, and override `_mel_params` if that
+    function takes parameters.
+    """
+
+    _kind = None
+
+    def __init__(self, hi, idx):
+        super().__init__(hi)
+        self._s0, self._s1 = (float(s) for s in np.asarray(hi.local_states))
+        self._idx = _static_idx(idx)
 
     @property
     def idx(self):
         """
-        The qubit id on which this rotation acts
+        The qubit id on which this gate acts
         """
         return self._idx
 
     @property
-    def dtype(self):
-        return complex
+    def max_conn_size(self) -> int:
+        return 2
 
     @property
-    def H(self):
-        return Rx(self.hilbert, self.idx, -self.angle)
-
-    def __eq__(self, o):
-        if isinstance(o, Rx):
-            return o.idx == self.idx and o.angle == self.angle
-        return False
+    def _mel_params(self):
+        return ()
 
-    def tree_flatten(self):
-        children = (self.angle,)
-        aux_data = (
-            self.hilbert,
-            self.idx,
+    def get_conn_padded(self, x):
+        return _get_conn_padded_impl(
+            x, self.idx, self._mel_params, self._kind, self._s0, self._s1
         )
-        return (children, aux_data)
 
-    @classmethod
-    def tree_unflatten(cls, aux_data, children):
-        (angle,) = children
-        return cls(*aux_data, angle)
+    def get_conn_padded_batched(self, x):
+        """
+        Same as `get_conn_padded`, but only accepts a batch of configurations
+        with a single leading batch axis.
 
-    @property
-    def max_conn_size(self) -> int:
-        return 2
+        This is the signature expected by vectorized callbacks, such as
+        :func:`jax.pure_callback` with `vectorized=True`.
 
-    @jax.jit
-    def get_conn_padded(self, x):
-        xr = x.reshape(-1, x.shape[-1])
-        xp, mels = get_conns_and_mels_Rx(xr, self.idx, self.angle, self._local_states)
-        xp = xp.reshape(x.shape[:-1] + xp.shape[-2:])
-        mels = mels.reshape(x.shape[:-1] + mels.shape[-1:])
-        return xp, mels
+        Args:
+            x: A matrix of shape `(B, N)` of configurations.
+
+        Returns:
+            The connected configurations `(B, 2, N)` and the corresponding
+            matrix elements `(B, 2)`.
+        """
+        if x.ndim != 2:
+            raise ValueError(
+                f"get_conn_padded_batched requires a 2D batch of configurations, "
+                f"but got an input of shape {x.shape}."
+            )
+        return self.get_conn_padded(x)
+
+    def _get_mels_soa(self, x):
+        """Real and imaginary parts of the matrix elements of `x`."""
+        return _get_mels_soa_impl(
+            x, self.idx, self._mel_params, self._kind, self._s0, self._s1
+        )
 
     def get_conn_flattened(self, x, sections):
         xp, mels = self.get_conn_padded(x)
-        sections[:] = np.arange(2, mels.size + 2, 2)
+        sections[:] = _sections(mels.size // 2)
 
         xp = xp.reshape(-1, self.hilbert.size)
         mels = mels.reshape(
@@ -80,37 +108,16 @@ class Rx(DiscreteJaxOperator):
         )
         return xp, mels
 
-    def to_local_operator(self):
-        ctheta = np.cos(self.angle / 2)
-        stheta = np.sin(self.angle / 2)
-        return ctheta - 1j * stheta * spin.sigmax(self.hilbert, self.idx)
-
-
-@partial(jax.vmap, in_axes=(0, None, None, None), out_axes=(0, 0))
-def get_conns_and_mels_Rx(sigma, idx, angle, local_states):
-    assert sigma.ndim == 1
-
-    state_0 = jnp.asarray(local_states[0], dtype=sigma.dtype)
-    state_1 = jnp.asarray(local_states[1], dtype=sigma.dtype)
-
-    conns = jnp.tile(sigma, (2, 1))
-    current_state = sigma[idx]
-    flipped_state = jnp.where(current_state == state_0, state_1, state_0)
-    conns = conns.at[1, idx].set(flipped_state)
-
-    mels = jnp.zeros(2, dtype=complex)
-    mels = mels.at[0].set(jnp.cos(angle / 2))
-    mels = mels.at[1].set(-1j * jnp.sin(angle / 2))
 
-    return conns, mels
+class _SingleQubitRotation(_SingleQubitGate):
+    """
+    Base class for single qubit rotations parametrized by an angle.
 
+    Subclasses must implement `_build_local_operator`.
+    """
 
-@register_pytree_node_class
-class Ry(DiscreteJaxOperator):
     def __init__(self, hi, idx, angle):
-        super().__init__(hi)
-        self._local_states = jnp.asarray(hi.local_states)
-        self._idx = idx
+        super().__init__(hi, idx)
         self._angle = angle
 
     @property
@@ -121,26 +128,18 @@ class Ry(DiscreteJaxOperator):
         return self._angle
 
     @property
-    def idx(self):
-        """
-        The qubit id on which this rotation acts
+    def dtype(self):
         """
-        return self._idx
+        The dtype of the matrix elements for double precision configurations.
 
-    @property
-    def dtype(self):
+        This is an upper bound: the matrix elements returned by
+        `get_conn_padded` follow the precision of the configurations, and are
+        `complex64` for `float32` configurations.
+        """
         return complex
 
-    @property
-    def H(self):
-        return Ry(self.hilbert, self.idx, -self.angle * 2)
-
-    @property
-    def max_conn_size(self) -> int:
-        return 2
-
     def __eq__(self, o):
-        if isinstance(o, Ry):
+        if isinstance(o, type(self)):
             return o.idx == self.idx and o.angle == self.angle
         return False
 
@@ -157,66 +156,80 @@ class Ry(DiscreteJaxOperator):
         (angle,) = children
         return cls(*aux_data, angle)
 
-    @jax.jit
-    def get_conn_padded(self, x):
-        xr = x.reshape(-1, x.shape[-1])
-        xp, mels = get_conns_and_mels_Ry(xr, self.idx, self.angle, self._local_states)
-        xp = xp.reshape(x.shape[:-1] + xp.shape[-2:])
-        mels = mels.reshape(x.shape[:-1] + mels.shape[-1:])
-        return xp, mels
+    @cached_property
+    def _cos_sin(self):
+        return _cos_sin_half(self.angle)
 
-    def get_conn_flattened(self, x, sections):
-        xp, mels = self.get_conn_padded(x)
-        sections[:] = np.arange(2, mels.size + 2, 2)
+    @property
+    def _mel_params(self):
+        return self._cos_sin
 
-        xp = xp.reshape(-1, self.hilbert.size)
-        mels = mels.reshape(
-            -1,
-        )
-        return xp, mels
+    @cached_property
+    def _local_operator(self):
+        return self._build_local_operator()
 
     def to_local_operator(self):
-        ctheta = np.cos(self.angle / 2)
-        stheta = np.sin(self.angle / 2)
-        return ctheta + 1j * stheta * spin.sigmay(self.hilbert, self.idx)
+        if isinstance(self.angle, jax.core.Tracer):
+            return self._build_local_operator()
+        # return a copy, as LocalOperators can be modified in place
+        return self._local_operator.copy()
+
 
+@register_pytree_node_class
+class Rx(_SingleQubitRotation):
+    _kind = "Rx"
 
-@partial(jax.vmap, in_axes=(0, None, None, None), out_axes=(0, 0))
-def get_conns_and_mels_Ry(sigma, idx, angle, local_states):
-    assert sigma.ndim == 1
+    @property
+    def H(self):
+        return Rx(self.hilbert, self.idx, -self.angle)
 
-    state_0 = jnp.asarray(local_states[0], dtype=sigma.dtype)
-    state_1 = jnp.asarray(local_states[1], dtype=sigma.dtype)
+    def _build_local_operator(self):
+        ctheta, stheta = self._cos_sin
+        return ctheta - 1j * stheta * spin.sigmax(self.hilbert, self.idx)
 
-    conns = jnp.tile(sigma, (2, 1))
-    current_state = sigma[idx]
-    flipped_state = jnp.where(current_state == state_0, state_1, state_0)
-    conns = conns.at[1, idx].set(flipped_state)
+    def get_conn_offdiag(self, x):
+        """
+        Returns only the off-diagonal part of `get_conn_padded`, without
+        materializing the diagonal connected element, which is `x` itself.
 
-    mels = jnp.zeros(2, dtype=complex)
-    mels = mels.at[0].set(jnp.cos(angle / 2))
-    phase_factor = jnp.where(conns.at[0, idx].get() == local_states[0], 1, -1)
-    mels = mels.at[1].set(phase_factor * jnp.sin(angle / 2))
+        Args:
+            x: A matrix of shape `(..., N)` of configurations.
 
-    return conns, mels
+        Returns:
+            The flipped configurations `(..., N)`, their matrix elements
+            `(...)` and the diagonal matrix element, a scalar shared by all
+            configurations.
+        """
+        c, s = self._cos_sin
+        return _get_conn_offdiag_Rx_impl(x, self.idx, c, s, self._s0, self._s1)
 
 
 @register_pytree_node_class
-class Hadamard(DiscreteJaxOperator):
-    def __init__(self, hi, idx):
-        super().__init__(hi)
-        self._local_states = jnp.asarray(hi.local_states)
-        self._idx = idx
+class Ry(_SingleQubitRotation):
+    _kind = "Ry"
 
     @property
-    def idx(self):
-        """
-        The qubit id on which this hadamard gate acts upon.
-        """
-        return self._idx
+    def H(self):
+        return Ry(self.hilbert, self.idx, -self.angle * 2)
+
+    def _build_local_operator(self):
+        ctheta, stheta = self._cos_sin
+        return ctheta + 1j * stheta * spin.sigmay(self.hilbert, self.idx)
+
+
+@register_pytree_node_class
+class Hadamard(_SingleQubitGate):
+    _kind = "H"
 
     @property
     def dtype(self):
+        """
+        The dtype of the matrix elements for double precision configurations.
+
+        This is an upper bound: the matrix elements returned by
+        `get_conn_padded` follow the precision of the configurations, and are
+        `float32` for `float32` configurations.
+        """
         return np.float64
 
     @property
@@ -243,46 +256,238 @@ class Hadamard(DiscreteJaxOperator):
     def tree_unflatten(cls, aux_data, children):
         return cls(*aux_data)
 
-    @property
-    def max_conn_size(self) -> int:
-        return 2
-
-    @jax.jit
-    def get_conn_padded(self, x):
-        xr = x.reshape(-1, x.shape[-1])
-        xp, mels = get_conns_and_mels_Hadamard(xr, self.idx, self._local_states)
-        xp = xp.reshape(x.shape[:-1] + xp.shape[-2:])
-        mels = mels.reshape(x.shape[:-1] + mels.shape[-1:])
-        return xp, mels
-
-    @jax.jit
-    def get_conn_flattened(self, x, sections):
-        xp, mels = self.get_conn_padded(x)
-        sections[:] = np.arange(2, mels.size + 2, 2)
-
-        xp = xp.reshape(-1, self.hilbert.size)
-        mels = mels.reshape(
-            -1,
-        )
-        return xp, mels
 
+def _Rx_elements(cos_half, sin_half, *, dtype):
+    """Real diagonal and imaginary off-diagonal matrix elements of Rx."""
+    return jnp.asarray(cos_half, dtype=dtype), jnp.asarray(-sin_half, dtype=dtype)
 
-@partial(jax.vmap, in_axes=(0, None, None), out_axes=(0, 0))
-def get_conns_and_mels_Hadamard(sigma, idx, local_states):
-    assert sigma.ndim == 1
 
-    state_0 = jnp.asarray(local_states[0], dtype=sigma.dtype)
-    state_1 = jnp.asarray(local_states[1], dtype=sigma.dtype)
+def _mels_Rx(sign, cos_half, sin_half, *, dtype):
+    diag, offdiag_im = _Rx_elements(cos_half, sin_half, dtype=dtype)
+    zeros = jnp.zeros(sign.shape, dtype=dtype)
+    mels_re = jnp.stack([jnp.broadcast_to(diag, sign.shape), zeros], axis=-1)
+    mels_im = jnp.stack([zeros, jnp.broadcast_to(offdiag_im, sign.shape)], axis=-1)
+    return mels_re, mels_im
+
+
+def _mels_Ry(sign, cos_half, sin_half, *, dtype):
+    mels_re = jnp.stack(
+        [
+            jnp.full(sign.shape, cos_half, dtype=dtype),
+            sign * jnp.asarray(sin_half, dtype=dtype),
+        ],
+        axis=-1,
+    )
+    return mels_re, jnp.zeros_like(mels_re)
+
+
+def _mels_Hadamard(sign, *, dtype):
+    mels_re = jnp.stack(
+        [sign.astype(dtype), jnp.ones(sign.shape, dtype=dtype)], axis=-1
+    ) / math.sqrt(2)
+    return mels_re, None
+
+
+def _sign(state, state_0, state_1):
+    """Returns +1 where `state == state_0` and -1 where `state == state_1`."""
+    if (state_0, state_1) == (-1.0, 1.0):
+        return -state
+    return (state_0 + state_1 - 2 * state) / (state_1 - state_0)
+
+
+def _mels_real_dtype(sigma_dtype):
+    """Real dtype of the matrix elements: single precision only if sigma is."""
+    if jnp.issubdtype(sigma_dtype, jnp.floating):
+        return np.promote_types(sigma_dtype, np.float32)
+    return jnp.dtype(float)
+
+
+# Real and imaginary parts of the matrix elements of every gate kind, computed
+# from the sign of the qubit and the gate parameters. Hadamard, the only gate
+# with a real dtype, returns `None` as imaginary part.
+_MEL_FNS = {
+    "Rx": _mels_Rx,
+    "Ry": _mels_Ry,
+    "H": _mels_Hadamard,
+}
+
+
+def _flip_qubit(sigma, idx, state_0, state_1):
+    """Returns `sigma` with qubit `idx` flipped, in the dtype of `sigma`."""
+    state_0 = jnp.asarray(state_0, dtype=sigma.dtype)
+    state_1 = jnp.asarray(state_1, dtype=sigma.dtype)
+    flipped_state = jnp.where(sigma[..., idx] == state_0, state_1, state_0)
+    return sigma.at[..., idx].set(flipped_state)
+
+
+def get_mels_soa_single_qubit(sigma, idx, params, kind, state_0, state_1):
+    """
+    Computes the matrix elements of a single qubit gate as two separate real
+    arrays, holding their real and imaginary parts.
+
+    See :func:`get_conns_and_mels_single_qubit` for the arguments.
+
+    Returns:
+        The real and imaginary parts, both of shape `(..., 2)`, of the matrix
+        elements. The imaginary part is `None` only for gates with a real
+        dtype (Hadamard). Single precision configurations give single
+        precision matrix elements.
+    """
+    dtype = _mels_real_dtype(sigma.dtype)
+    sign = _sign(sigma[..., idx].astype(dtype), state_0, state_1)
+    return _MEL_FNS[kind](sign, *params, dtype=dtype)
+
+
+def get_conns_and_mels_single_qubit(sigma, idx, params, kind, state_0, state_1):
+    """
+    Kernel shared by all single qubit gates.
+
+    The kernel is written directly in terms of the last axis of `sigma`, so any
+    number of leading batch dimensions is supported without reshaping.
+
+    Args:
+        sigma: batch of configurations of shape `(..., N)`.
+        idx: the qubit on which the gate acts.
+        params: tuple of gate parameters, forwarded to `_MEL_FNS[kind]`.
+        kind: the gate kind, a python string resolved at trace time.
+        state_0: the first local state of the qubit.
+        state_1: the second local state of the qubit.
+
+    Returns:
+        The connected configurations `(..., 2, N)` and matrix elements
+        `(..., 2)`. The matrix elements are in single precision if `sigma` is,
+        and in double precision otherwise.
+    """
+    flipped_row = _flip_qubit(sigma, idx, state_0, state_1)
+    conns = jnp.stack([sigma, flipped_row], axis=-2)
+
+    mels_re, mels_im = get_mels_soa_single_qubit(
+        sigma, idx, params, kind, state_0, state_1
+    )
+    if mels_im is not None:
+        mels = jax.lax.complex(mels_re, mels_im)
+    else:
+        mels = mels_re
 
-    conns = jnp.tile(sigma, (2, 1))
-    current_state = sigma[idx]
-    flipped_state = jnp.where(current_state == state_0, state_1, state_0)
-    conns = conns.at[1, idx].set(flipped_state)
+    return conns, mels
 
-    mels = jnp.zeros(2, dtype=float)
-    mels = mels.at[1].set(1 / jnp.sqrt(2))
-    state_value = conns.at[0, idx].get()
-    mels_value = jnp.where(state_value == local_states[0], 1, -1) / jnp.sqrt(2)
-    mels = mels.at[0].set(mels_value)
 
-    return conns, mels
+def get_conns_and_mels_Rx(sigma, idx, cos_half, sin_half, state_0, state_1):
+    return get_conns_and_mels_single_qubit(
+        sigma, idx, (cos_half, sin_half), "Rx", state_0, state_1
+    )
+
+
+def get_conn_offdiag_Rx(sigma, idx, cos_half, sin_half, state_0, state_1):
+    """
+    Off-diagonal part of :func:`get_conns_and_mels_Rx`.
+
+    Row 0 of the connected configurations of Rx is `sigma` itself, with the
+    same matrix element `cos(angle/2)` for every configuration. This returns
+    only the flipped configurations `(..., N)` and their matrix elements
+    `(...)`, together with that diagonal matrix element, so that callers can
+    add the diagonal contribution without copying `sigma`.
+    """
+    flipped_sigma = _flip_qubit(sigma, idx, state_0, state_1)
+
+    dtype = _mels_real_dtype(sigma.dtype)
+    mel_diag, offdiag_im = _Rx_elements(cos_half, sin_half, dtype=dtype)
+    batch_shape = sigma.shape[:-1]
+    mel_off = jax.lax.complex(
+        jnp.zeros(batch_shape, dtype=dtype), jnp.broadcast_to(offdiag_im, batch_shape)
+    )
+
+    return flipped_sigma, mel_off, mel_diag
+
+
+def get_conns_and_mels_Ry(sigma, idx, cos_half, sin_half, state_0, state_1):
+    return get_conns_and_mels_single_qubit(
+        sigma, idx, (cos_half, sin_half), "Ry", state_0, state_1
+    )
+
+
+def get_conns_and_mels_Hadamard(sigma, idx, state_0, state_1):
+    return get_conns_and_mels_single_qubit(sigma, idx, (), "H", state_0, state_1)
+
+
+def get_conns_and_mels_single_qubit_batched(
+    sigma, idxs, params, kind, state_0, state_1
+):
+    """
+    Evaluates :func:`get_conns_and_mels_single_qubit` for several gates of the
+    same kind at once, on the same configurations.
+
+    Args:
+        sigma: batch of configurations of shape `(..., N)`.
+        idxs: array `(n_ops,)` with the qubit on which every gate acts.
+        params: tuple of gate parameters, each stacked along a leading axis of
+            size `n_ops`.
+        kind: the gate kind, a python string resolved at trace time.
+        state_0: the first local state of the qubit.
+        state_1: the second local state of the qubit.
+
+    Returns:
+        The connected configurations `(n_ops, ..., 2, N)` and matrix elements
+        `(n_ops, ..., 2)`.
+    """
+    kernel = partial(
+        get_conns_and_mels_single_qubit, kind=kind, state_0=state_0, state_1=state_1
+    )
+    return jax.vmap(kernel, in_axes=(None, 0, 0))(sigma, idxs, params)
+
+
+def get_conns_batched(operators, x):
+    """
+    Computes the connected elements of several single qubit gates of the same
+    type on the same configurations, with a single kernel launch instead of
+    one per gate.
+
+    Args:
+        operators: a sequence of gates (e.g. :class:`Rx`) of the same type and
+            defined on the same hilbert space.
+        x: A matrix of shape `(..., N)` of configurations.
+
+    Returns:
+        The connected configurations `(n_ops, ..., 2, N)` and matrix elements
+        `(n_ops, ..., 2)`, where the first axis follows the order of
+        `operators`.
+    """
+    operators = list(operators)
+    if len(operators) == 0:
+        raise ValueError("get_conns_batched requires at least one operator.")
+
+    op = operators[0]
+    if not isinstance(op, _SingleQubitGate):
+        raise TypeError(
+            f"get_conns_batched only supports single qubit gates, not {type(op)}."
+        )
+    for o in operators:
+        if type(o) is not type(op) or o.hilbert != op.hilbert:
+            raise TypeError(
+                "All operators passed to get_conns_batched must be of the same "
+                "type and act on the same hilbert space. Group them by type "
+                "before calling this function."
+            )
+
+    idxs = jnp.asarray([o.idx for o in operators])
+    params = tuple(jnp.stack(p) for p in zip(*(o._mel_params for o in operators)))
+    return _get_conns_batched_impl(x, idxs, params, op._kind, op._s0, op._s1)
+
+
+# Jitted kernels shared by all gate instances, static in the gate structure.
+_get_conn_padded_impl = jax.jit(
+    get_conns_and_mels_single_qubit,
+    static_argnames=("idx", "kind", "state_0", "state_1"),
+)
+_get_mels_soa_impl = jax.jit(
+    get_mels_soa_single_qubit,
+    static_argnames=("idx", "kind", "state_0", "state_1"),
+)
+_get_conn_offdiag_Rx_impl = jax.jit(
+    get_conn_offdiag_Rx,
+    static_argnames=("idx", "state_0", "state_1"),
+)
+_get_conns_batched_impl = jax.jit(
+    get_conns_and_mels_single_qubit_batched,
+    static_argnames=("kind", "state_0", "state_1"),
+)
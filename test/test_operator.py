@@ -1,7 +1,10 @@
+import warnings
+
 import pytest
 import netket as nk
 import numpy as np
 from netket_fidelity.operator import singlequbit_gates as sg
+import jax
 from jax import numpy as jnp
 import netket_fidelity as nkf
 
@@ -28,6 +31,127 @@ def test_operator_dense_and_conversion(operator):
     assert operator.hilbert == operator.to_local_operator().hilbert
 
 
+@pytest.mark.parametrize(
+    "operator",
+    [pytest.param(val, id=f"operator={name}") for name, val in operators.items()],
+)
+def test_get_conn_padded_batched(operator):
+    x = hi.all_states()
+
+    xp, mels = operator.get_conn_padded(x)
+    xp_b, mels_b = operator.get_conn_padded_batched(x)
+
+    assert xp_b.shape == (x.shape[0], 2, N)
+    assert mels_b.shape == (x.shape[0], 2)
+    np.testing.assert_allclose(xp_b, xp)
+    np.testing.assert_allclose(mels_b, mels)
+
+    with pytest.raises(ValueError):
+        operator.get_conn_padded_batched(x.reshape(2, -1, N))
+
+
+@pytest.mark.parametrize(
+    "operator",
+    [pytest.param(val, id=f"operator={name}") for name, val in operators.items()],
+)
+def test_get_mels_soa(operator):
+    x = hi.all_states()
+
+    _, mels = operator.get_conn_padded(x)
+    mels_re, mels_im = operator._get_mels_soa(x)
+
+    np.testing.assert_allclose(mels_re, mels.real)
+    if isinstance(operator, nkf.operator.Hadamard):
+        assert mels_im is None
+    else:
+        np.testing.assert_allclose(mels_im, mels.imag)
+
+
+@pytest.mark.parametrize("dtype", [np.float64, np.float32, np.int8])
+@pytest.mark.parametrize(
+    "operator, method",
+    [
+        pytest.param(val, "get_conn_padded", id=f"{name}.get_conn_padded")
+        for name, val in operators.items()
+    ]
+    + [pytest.param(operators["Rx"], "get_conn_offdiag", id="Rx.get_conn_offdiag")],
+)
+def test_conn_dtype(operator, method, dtype):
+    x = hi.all_states()
+
+    expected = getattr(operator, method)(x)
+    with warnings.catch_warnings(), jax.numpy_dtype_promotion("strict"):
+        warnings.simplefilter("error")
+        out = getattr(operator, method)(x.astype(dtype))
+
+    assert out[0].dtype == dtype
+    for o, e in zip(out, expected):
+        np.testing.assert_allclose(o, e, rtol=1e-6)
+
+
+@pytest.mark.parametrize(
+    "operator",
+    [pytest.param(val, id=f"operator={name}") for name, val in operators.items()],
+)
+def test_mels_precision(operator):
+    x = hi.all_states()
+
+    _, mels = operator.get_conn_padded(x.astype(np.float64))
+    _, mels_32 = operator.get_conn_padded(x.astype(np.float32))
+
+    # operator.dtype is the double precision upper bound of the mels dtype
+    op_dtype = np.dtype(operator.dtype)
+    assert mels.dtype == op_dtype
+    assert mels_32.dtype.kind == op_dtype.kind
+    assert mels_32.dtype.itemsize == op_dtype.itemsize // 2
+    assert np.promote_types(mels_32.dtype, op_dtype) == op_dtype
+    np.testing.assert_allclose(mels_32, mels, rtol=1e-6)
+
+
+def test_get_conn_offdiag_Rx():
+    operator = operators["Rx"]
+    x = hi.all_states()
+
+    xp, mels = operator.get_conn_padded(x)
+    x_off, mel_off, mel_diag = operator.get_conn_offdiag(x)
+
+    np.testing.assert_allclose(x_off, xp[:, 1])
+    np.testing.assert_allclose(mel_off, mels[:, 1])
+    np.testing.assert_allclose(mel_diag, mels[:, 0])
+
+
+@pytest.mark.parametrize(
+    "ops",
+    [
+        pytest.param(
+            [nkf.operator.Rx(hi, i, 0.1 * (i + 1)) for i in range(N)], id="Rx"
+        ),
+        pytest.param(
+            [nkf.operator.Ry(hi, i, 0.1 * (i + 1)) for i in range(N)], id="Ry"
+        ),
+        pytest.param([nkf.operator.Hadamard(hi, i) for i in range(N)], id="Hadamard"),
+    ],
+)
+def test_get_conns_batched(ops):
+    x = hi.all_states()
+
+    xp_b, mels_b = nkf.operator.get_conns_batched(ops, x)
+
+    assert xp_b.shape == (len(ops), x.shape[0], 2, N)
+    assert mels_b.shape == (len(ops), x.shape[0], 2)
+    for i, op in enumerate(ops):
+        xp, mels = op.get_conn_padded(x)
+        np.testing.assert_allclose(xp_b[i], xp)
+        np.testing.assert_allclose(mels_b[i], mels)
+
+
+def test_get_conns_batched_mixed_types():
+    with pytest.raises(TypeError):
+        nkf.operator.get_conns_batched(
+            [operators["Rx"], operators["Ry"]], hi.all_states()
+        )
+
+
 def test_get_conns_and_mels():
     hi_spin = nk.hilbert.Spin(s=0.5, N=3)
     hi_qubit = nk.hilbert.Qubit(N=3)
@@ -44,23 +168,23 @@ def test_get_conns_and_mels():
     sigma_spin = jnp.array([sigma_2_spin, sigma_7_spin])
 
     conns_rx_qubit, mels_rx_qubit = sg.get_conns_and_mels_Rx(
-        sigma_qubit, 0, np.pi / 2, local_state_qubit
+        sigma_qubit, 0, np.cos(np.pi / 4), np.sin(np.pi / 4), *local_state_qubit
     )
     conns_ry_qubit, mels_ry_qubit = sg.get_conns_and_mels_Ry(
-        sigma_qubit, 0, np.pi / 2, local_state_qubit
+        sigma_qubit, 0, np.cos(np.pi / 4), np.sin(np.pi / 4), *local_state_qubit
     )
     conns_h_qubit, mels_h_qubit = sg.get_conns_and_mels_Hadamard(
-        sigma_qubit, 0, local_state_qubit
+        sigma_qubit, 0, *local_state_qubit
     )
 
     conns_rx_spin, mels_rx_spin = sg.get_conns_and_mels_Rx(
-        sigma_spin, 0, np.pi / 2, local_state_spin
+        sigma_spin, 0, np.cos(np.pi / 4), np.sin(np.pi / 4), *local_state_spin
     )
     conns_ry_spin, mels_ry_spin = sg.get_conns_and_mels_Ry(
-        sigma_spin, 0, np.pi / 2, local_state_spin
+        sigma_spin, 0, np.cos(np.pi / 4), np.sin(np.pi / 4), *local_state_spin
     )
     conns_h_spin, mels_h_spin = sg.get_conns_and_mels_Hadamard(
-        sigma_spin, 0, local_state_spin
+        sigma_spin, 0, *local_state_spin
     )
 
     conns_check_qubit = jnp.array(